@@ -0,0 +1,10 @@
+# Gunicorn settings for running the service with several worker processes:
+#   uv run gunicorn main:app
+bind = '127.0.0.1:5000'
+workers = 4
+preload_app = True # Import main (schema + cache warm) once in the master, then fork the workers
+
+def post_worker_init(worker):
+    """Starts the worker's invalidation listener; threads started in the master do not survive fork."""
+    import main
+    main.start_invalidation_listener()
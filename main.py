@@ -1,43 +1,111 @@
 import sqlite3
-import json
-import random
+import functools
+import hmac
+import logging
+import os
+import queue
+import threading
 import time
+from dataclasses import dataclass
+from typing import Any
+import msgpack
+import orjson
+import xxhash
 import redis # Import the redis library
-from flask import Flask, request, jsonify, g
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+from flask import Flask, g, request, jsonify
+from flask.json.provider import JSONProvider
 
 # --- Configuration ---
 DATABASE = 'feature_flags.db'
+# Applied to every new connection. WAL lets readers run alongside a writer;
+# synchronous=NORMAL is durable in WAL mode except across an OS crash.
+SQLITE_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-64000;
+"""
+DB_POOL_SIZE = 8 # Idle connections kept for reuse; extra ones opened under load are closed when released
+# Column order unpacked by flag_row_to_dict; every query that reads flags selects exactly these
+FLAG_COLUMNS = 'id, name, type, default_value, enabled, targeting_rules, percentage_bps'
 API_KEY = 'your_super_secret_api_key' # In a real app, use environment variables or a secure vault
+API_KEY_BYTES = API_KEY.encode() # Encoded once for the constant-time comparison in require_api_key
 
 # Redis Configuration
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 REDIS_DB = 0
+# (host, port, db) of each Redis instance holding flag keys; pick_shard spreads
+# names over them. The first entry is the control shard: it also carries
+# invalidation messages.
+REDIS_SHARDS = [(REDIS_HOST, REDIS_PORT, REDIS_DB)]
 REDIS_CACHE_TTL_SECONDS = 300 # Time-to-live for individual flag configurations in Redis (5 minutes)
 REDIS_FLAG_PREFIX = 'flag:' # Prefix for Redis keys to avoid conflicts
+REDIS_INVALIDATION_CHANNEL = 'flag_invalidations' # Pub/sub channel carrying names of changed flags
+REDIS_RESUBSCRIBE_DELAY_SECONDS = 5 # Wait before retrying a dropped invalidation subscription; doubles while Redis stays down
+REDIS_RESUBSCRIBE_MAX_DELAY_SECONDS = 60 # Upper bound for that wait
+REDIS_RETRY_DELAY_SECONDS = 5 # While Redis is unreachable, use only the database for this long before retrying
+REDIS_CONNECT_TIMEOUT_SECONDS = 0.25 # A connect attempt to an unreachable Redis gives up after this long
+
+# Local (per-process) Cache Configuration
+LOCAL_CACHE_TTL_SECONDS = 5 # Upper bound on staleness if an invalidation message is missed
+MISSING_FLAG_TTL_SECONDS = 30 # How long a name found in neither Redis nor SQLite is answered as missing
+MISSING_FLAG_CACHE_SIZE = 256 # Most recently missed names kept; older ones are dropped first
+
+# Messages are emitted at DEBUG on the hot path; logging is configured only when run as a script
+logger = logging.getLogger(__name__)
+
+# --- JSON Serialization ---
+class OrjsonProvider(JSONProvider):
+    """Serializes request and response bodies (jsonify, get_json) with orjson."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # --- Database Helper Functions ---
+# Idle connections shared by all threads. A request borrows one for the life of
+# its app context and returns it on teardown, so connecting and applying the
+# pragmas happens once per pooled connection rather than once per request or
+# per thread (the dev server starts a new thread for every request).
+db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
 def get_db():
-    """Establishes a database connection or returns the existing one."""
+    """Returns the app context's database connection, borrowing one from the pool if needed."""
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row # This allows accessing columns by name
+        try:
+            g.db = db_pool.get_nowait()
+        except queue.Empty:
+            # Autocommit: each statement is its own transaction, so a pooled
+            # connection never holds a read snapshot open between requests.
+            # It is used by one thread at a time, but not always the same one.
+            g.db = sqlite3.connect(DATABASE, isolation_level=None, check_same_thread=False)
+            g.db.executescript(SQLITE_PRAGMAS)
     return g.db
 
 @app.teardown_appcontext
-def close_db(e=None):
-    """Closes the database connection at the end of the request."""
+def release_db(e=None):
+    """Returns the connection to the pool at the end of the request, or closes it if the pool is full."""
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        try:
+            db_pool.put_nowait(db)
+        except queue.Full:
+            db.close()
 
 def init_db():
     """Initializes the database schema."""
     with app.app_context():
         db = get_db()
         cursor = db.cursor()
+        # name is UNIQUE, so SQLite already maintains an index for lookups by name
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS feature_flags (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,157 +113,553 @@ def init_db():
                 type TEXT NOT NULL, -- 'boolean', 'string', 'number', 'json'
                 default_value TEXT,
                 enabled INTEGER DEFAULT 0, -- 0 for false, 1 for true
-                targeting_rules TEXT -- JSON string for complex rules
+                targeting_rules TEXT, -- JSON string for complex rules
+                percentage_bps INTEGER -- Rollout percentage in basis points, kept out of targeting_rules
             )
         ''')
-        db.commit()
-        print(f"Database '{DATABASE}' initialized successfully.")
+        columns = [column[1] for column in cursor.execute('PRAGMA table_info(feature_flags)')] # (cid, name, type, ...)
+        if 'percentage_bps' not in columns:
+            # Move numeric percentages out of the JSON rules of databases created before the column
+            cursor.execute('ALTER TABLE feature_flags ADD COLUMN percentage_bps INTEGER')
+            cursor.execute('''
+                UPDATE feature_flags
+                SET percentage_bps = CAST(round(json_extract(targeting_rules, '$.percentage') * 100) AS INTEGER),
+                    targeting_rules = nullif(json_remove(targeting_rules, '$.percentage'), '{}')
+                WHERE CASE WHEN json_valid(targeting_rules)
+                    THEN json_type(targeting_rules, '$.percentage') IN ('integer', 'real')
+                        AND json_extract(targeting_rules, '$.percentage') BETWEEN 0 AND 100 END
+            ''')
+            logger.info("Moved %d rollout percentage(s) to the percentage_bps column.", cursor.rowcount)
+        logger.info("Database '%s' initialized successfully.", DATABASE)
 
 # --- Redis Helper Functions ---
-def get_redis_client():
-    """Establishes a Redis connection or returns the existing one."""
-    if 'redis' not in g:
+# One client per shard and process. Its connection pool keeps connections open
+# across requests, so a request costs only the commands it sends (no connect or PING).
+redis_shards = [None] * len(REDIS_SHARDS)
+redis_retry_at = [0.0] * len(REDIS_SHARDS) # time.monotonic() before which a shard is not retried after a failure
+# Errors meaning a Redis instance cannot be reached; callers fall back to the database
+REDIS_UNAVAILABLE_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+def connect_redis(shard):
+    """Creates a client for a shard that fails fast, without redis-py's retries and backoff."""
+    host, port, db = REDIS_SHARDS[shard]
+    return redis.StrictRedis(
+        host=host, port=port, db=db, # Values are raw MessagePack bytes
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS,
+        retry=Retry(NoBackoff(), 0),
+    )
+
+def get_redis_client(shard=0):
+    """Returns the process-wide client for a shard, or None while it is unreachable. Shard 0 is the control shard."""
+    if redis_shards[shard] is None and time.monotonic() >= redis_retry_at[shard]:
+        # Claim the attempt up front: concurrent requests keep using the database
+        # instead of all waiting on their own reconnect
+        redis_retry_at[shard] = time.monotonic() + REDIS_RETRY_DELAY_SECONDS
+        try:
+            client = connect_redis(shard)
+            client.ping() # Test connection once, not on every request
+            redis_shards[shard] = client
+            redis_retry_at[shard] = 0.0
+            logger.info("Connected to Redis shard %d successfully.", shard)
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            mark_redis_unavailable(e, shard)
+    return redis_shards[shard]
+
+def mark_redis_unavailable(error, shard=0):
+    """Drops a shard's client after a connection error; callers fall back to the database until the retry delay passes."""
+    logger.warning("Could not connect to Redis shard %d: %s. Falling back to database only.", shard, error)
+    redis_shards[shard] = None
+    redis_retry_at[shard] = time.monotonic() + REDIS_RETRY_DELAY_SECONDS
+
+def pick_shard(flag_name, num_shards):
+    """
+    Returns the shard holding a flag's key, using jump consistent hash
+    (Lamping & Veach). Going from N to N+1 shards moves only about 1/(N+1)
+    of the keys, where hash % N would move almost all of them.
+    """
+    key = xxhash.xxh3_64_intdigest(flag_name.encode())
+    shard, candidate = -1, 0
+    while candidate < num_shards:
+        shard = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((shard + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return shard
+
+def group_by_shard(flag_names):
+    """Groups flag names by the shard holding their keys. Returns a dict of shard to names."""
+    shards = {}
+    for flag_name in flag_names:
+        shards.setdefault(pick_shard(flag_name, len(REDIS_SHARDS)), []).append(flag_name)
+    return shards
+
+# --- Compiled Flags ---
+# Convert a stored flag value to the flag's declared type.
+# This is a simplification; a full system would handle type casting more robustly.
+def cast_boolean(value):
+    # Convert "true"/"false" strings to actual booleans
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(int(value)) if value is not None else False
+
+def cast_number(value):
+    try:
+        return float(value) if value is not None else None
+    except (ValueError, TypeError):
+        return None # Or handle error
+
+def cast_json(value):
+    try:
+        return orjson.loads(value) if value is not None else None
+    except orjson.JSONDecodeError:
+        return None # Or handle error
+
+def cast_string(value): # string or other types
+    return value
+
+CASTERS = {'boolean': cast_boolean, 'number': cast_number, 'json': cast_json}
+
+@dataclass(slots=True, frozen=True)
+class CompiledFlag:
+    """
+    Evaluation-ready form of a flag config, built once when the flag is cached
+    so evaluate_compiled_flag only does attribute reads instead of re-inspecting the rules.
+    """
+    name: str
+    enabled: bool
+    value: Any # default_value already cast to the flag's type
+    user_ids: frozenset | None # None when the flag has no user_ids rule
+    percentage_bps: int | None # Rollout percentage in basis points, None when there is no percentage rule
+    config: dict # The flag config as stored, returned as-is by the /flags endpoints
+    name_hash: int # hash64 of the name, mixed with the user's hash for rollout bucketing
+    static_response: bytes | None # Pre-serialized /evaluate body when the value cannot depend on the user
+
+def compile_flag(flag_dict):
+    """Builds a CompiledFlag from a flag config dict."""
+    rules = flag_dict.get('targeting_rules')
+    if not isinstance(rules, dict): # Malformed rules stored before they were validated are ignored
+        rules = {}
+    percentage = rules.get('percentage')
+    cast = CASTERS.get(flag_dict['type'], cast_string)
+    value = cast(flag_dict['default_value'])
+    user_ids = rules.get('user_ids')
+    user_ids = frozenset(user_id for user_id in user_ids if isinstance(user_id, str)) if isinstance(user_ids, list) else None
+    percentage_bps = round(percentage * 100) if isinstance(percentage, (int, float)) else None
+    # Disabled flags and flags without targeting rules evaluate the same for every user
+    user_independent = not flag_dict['enabled'] or (user_ids is None and percentage_bps is None)
+    return CompiledFlag(
+        name=flag_dict['name'],
+        enabled=bool(flag_dict['enabled']),
+        value=value,
+        user_ids=user_ids,
+        percentage_bps=percentage_bps,
+        config=flag_dict,
+        name_hash=hash64(flag_dict['name']),
+        static_response=orjson.dumps({"flag_name": flag_dict['name'], "value": value}) if user_independent else None,
+    )
+
+# --- Local Cache ---
+# flag_name -> (expires_at, CompiledFlag). Serves hot flags without a Redis round-trip;
+# entries are evicted by invalidation messages from any worker, or expire after a short TTL.
+local_flag_cache = {}
+
+# flag_name -> expires_at for names that do not exist, so repeated lookups of
+# unknown names (typos, probes) stop reaching Redis and SQLite. Cleared by the
+# same invalidation messages, which are also published when a flag is created.
+missing_flag_cache = {}
+missing_flag_lock = threading.Lock() # Guards missing_flag_cache and flag_write_count
+# Flag writes this process has seen (its own, or invalidation messages). A lookup
+# that misses only records the name if no write happened while it was running.
+flag_write_count = 0
+
+def remember_flag(flag_dict):
+    """Compiles a flag config and stores it in this process's local cache."""
+    flag = compile_flag(flag_dict)
+    local_flag_cache[flag.name] = (time.monotonic() + LOCAL_CACHE_TTL_SECONDS, flag)
+    with missing_flag_lock:
+        missing_flag_cache.pop(flag.name, None)
+    return flag
+
+def forget_flag(flag_name=None):
+    """Counts a flag write and evicts the flag from the local caches, or every flag if flag_name is None."""
+    global flag_write_count
+    with missing_flag_lock:
+        flag_write_count += 1
+        if flag_name is None:
+            local_flag_cache.clear()
+            missing_flag_cache.clear()
+        else:
+            local_flag_cache.pop(flag_name, None)
+            missing_flag_cache.pop(flag_name, None)
+
+def remember_missing_flag(flag_name, writes_before_lookup):
+    """
+    Records that a flag does not exist, evicting the oldest entry when the cache is full.
+    writes_before_lookup is flag_write_count from before the lookup; if a write
+    happened since, the lookup may predate the flag's creation and is not recorded.
+    """
+    with missing_flag_lock:
+        if flag_write_count != writes_before_lookup:
+            return
+        missing_flag_cache.pop(flag_name, None) # Re-insert so dict order stays oldest-first
+        if len(missing_flag_cache) >= MISSING_FLAG_CACHE_SIZE:
+            missing_flag_cache.pop(next(iter(missing_flag_cache)), None)
+        missing_flag_cache[flag_name] = time.monotonic() + MISSING_FLAG_TTL_SECONDS
+
+def is_known_missing(flag_name, now):
+    """True if flag_name was recently looked up and not found."""
+    expires_at = missing_flag_cache.get(flag_name)
+    return expires_at is not None and expires_at > now
+
+def listen_for_invalidations():
+    """
+    Subscribes to the invalidation channel and evicts changed flags from the
+    local cache. Runs forever in a daemon thread, resubscribing if Redis drops.
+    Redis is optional, so only the first failure in a row is logged as a warning.
+    """
+    delay = None # Seconds to wait before the next attempt; None while subscribed
+    while True:
         try:
-            g.redis = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
-            g.redis.ping() # Test connection
-            print("Connected to Redis successfully.")
-        except redis.exceptions.ConnectionError as e:
-            print(f"Could not connect to Redis: {e}. Falling back to database only.")
-            g.redis = None # Set to None if connection fails
-    return g.redis
+            pubsub = connect_redis(0).pubsub(ignore_subscribe_messages=True) # Invalidations are published on the control shard
+            pubsub.subscribe(REDIS_INVALIDATION_CHANNEL)
+            forget_flag() # Messages may have been missed while unsubscribed
+            delay = None
+            for message in pubsub.listen():
+                forget_flag(message['data'].decode())
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            if delay is None:
+                delay = REDIS_RESUBSCRIBE_DELAY_SECONDS
+                logger.warning("Lost Redis invalidation subscription: %s. Retrying in %ss.", e, delay)
+            else:
+                delay = min(delay * 2, REDIS_RESUBSCRIBE_MAX_DELAY_SECONDS)
+                logger.debug("Redis invalidation subscription still unavailable: %s. Retrying in %ss.", e, delay)
+            time.sleep(delay)
+
+def start_invalidation_listener():
+    """Starts the background thread that keeps the local cache in sync with other workers."""
+    threading.Thread(target=listen_for_invalidations, name='flag-invalidations', daemon=True).start()
+
+def targeting_rules_error(rules):
+    """Returns an error message if targeting rules from a request are malformed, otherwise None."""
+    if rules is None:
+        return None
+    if not isinstance(rules, dict):
+        return "targeting_rules must be an object"
+    user_ids = rules.get('user_ids', [])
+    if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+        return "targeting_rules.user_ids must be a list of user IDs"
+    if 'percentage' in rules:
+        percentage = rules['percentage']
+        if isinstance(percentage, bool) or not isinstance(percentage, (int, float)) or not 0 <= percentage <= 100:
+            return "targeting_rules.percentage must be a number between 0 and 100"
+    return None
+
+def split_targeting_rules(rules):
+    """
+    Splits targeting rules into the JSON stored in targeting_rules and the
+    percentage_bps column. Returns (rules JSON or None, percentage_bps or None).
+    """
+    if isinstance(rules, dict) and isinstance(rules.get('percentage'), (int, float)):
+        rules = dict(rules)
+        percentage_bps = round(rules.pop('percentage') * 100)
+    else:
+        percentage_bps = None
+    # Flags with only a rollout percentage store no JSON, so loading them parses none
+    return (orjson.dumps(rules).decode() if rules else None), percentage_bps
+
+def flag_row_to_dict(row):
+    """Converts a feature_flags row (selected as FLAG_COLUMNS) into a flag config dict with parsed targeting rules."""
+    flag_id, name, flag_type, default_value, enabled, targeting_rules, percentage_bps = row
+    # Parse targeting rules from JSON string back to a Python object
+    try:
+        rules = orjson.loads(targeting_rules) if targeting_rules else {}
+    except orjson.JSONDecodeError as e: # One bad row must not stop the whole table from loading
+        logger.warning("Ignoring malformed targeting rules of flag '%s': %s", name, e)
+        rules = {}
+    if percentage_bps is not None and isinstance(rules, dict): # Clients still see the percentage inside targeting_rules
+        rules['percentage'] = percentage_bps // 100 if percentage_bps % 100 == 0 else percentage_bps / 100
+    return {
+        'id': flag_id,
+        'name': name,
+        'type': flag_type,
+        'default_value': default_value,
+        'enabled': enabled,
+        'targeting_rules': rules,
+    }
+
+def cache_flags(flag_dicts, notify_peers=False):
+    """
+    Writes flag configs through to the local and Redis caches, using one
+    Redis pipeline per shard for the whole batch.
+    Called whenever flags are written to SQLite so readers never have to
+    fall back to the database for a flag that was just created or updated.
+    With notify_peers=True, other workers are told to drop their local copy.
+    Returns the CompiledFlags stored in the local cache.
+    """
+    if notify_peers:
+        for flag_dict in flag_dicts: # Counted before caching, so a concurrent miss is either skipped or cleared
+            forget_flag(flag_dict['name'])
+    flags = [remember_flag(flag_dict) for flag_dict in flag_dicts]
+    pipes = {} # shard -> pipeline, or None if the shard is unreachable
+    for flag_dict in flag_dicts:
+        shard = pick_shard(flag_dict['name'], len(REDIS_SHARDS))
+        if shard not in pipes:
+            r = get_redis_client(shard)
+            pipes[shard] = r.pipeline(transaction=False) if r else None
+        if pipes[shard]:
+            key = f"{REDIS_FLAG_PREFIX}{flag_dict['name']}"
+            pipes[shard].setex(key, REDIS_CACHE_TTL_SECONDS, msgpack.packb(flag_dict))
+    control = get_redis_client()
+    if control and notify_peers and flag_dicts:
+        if pipes.get(0) is None:
+            pipes[0] = control.pipeline(transaction=False)
+        for flag_dict in flag_dicts:
+            pipes[0].publish(REDIS_INVALIDATION_CHANNEL, flag_dict['name'])
+    # The control shard goes last, so peers told to reload find the new values already written
+    for shard in sorted(pipes, reverse=True):
+        if pipes[shard]:
+            try:
+                pipes[shard].execute()
+                logger.debug("Cached flag(s) in Redis shard %d.", shard)
+            except REDIS_UNAVAILABLE_ERRORS as e:
+                mark_redis_unavailable(e, shard)
+    return flags
+
+def cache_flag(flag_dict, notify_peers=False):
+    """Single-flag version of cache_flags. Returns the cached CompiledFlag."""
+    return cache_flags([flag_dict], notify_peers)[0]
+
+def load_all_flags_from_db():
+    """Reads every flag from SQLite and caches them all. Returns flag config dicts."""
+    cursor = get_db().cursor()
+    cursor.execute(f'SELECT {FLAG_COLUMNS} FROM feature_flags')
+    flag_dicts = [flag_row_to_dict(flag) for flag in cursor] # Rows are unpacked as they are read, without a fetchall() list
+    cache_flags(flag_dicts)
+    return flag_dicts
+
+def warm_flag_cache():
+    """Loads every flag from SQLite into Redis once, so evaluations start on a warm cache."""
+    with app.app_context():
+        load_all_flags_from_db()
 
 def invalidate_flag_cache(flag_name):
-    """Invalidates a specific flag's entry in the Redis cache."""
-    r = get_redis_client()
+    """
+    Drops a flag that no longer exists (deleted or renamed) from the Redis cache
+    and from every worker's local cache.
+    """
+    local_flag_cache.pop(flag_name, None)
+    shard = pick_shard(flag_name, len(REDIS_SHARDS))
+    r = get_redis_client(shard)
     if r:
-        key = f"{REDIS_FLAG_PREFIX}{flag_name}"
-        r.delete(key)
-        print(f"Invalidated Redis cache for flag: {flag_name}")
+        try:
+            r.delete(f"{REDIS_FLAG_PREFIX}{flag_name}")
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            mark_redis_unavailable(e, shard)
+    control = get_redis_client()
+    if control:
+        try:
+            control.publish(REDIS_INVALIDATION_CHANNEL, flag_name)
+            logger.debug("Invalidated Redis cache for flag: %s", flag_name)
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            mark_redis_unavailable(e)
 
 def get_flag_from_cache_or_db(flag_name):
     """
-    Attempts to retrieve a flag from Redis cache,
-    falls back to SQLite if not found or expired, and populates Redis.
+    Attempts to retrieve a flag from the local cache, then from Redis,
+    falls back to SQLite if not found or expired, and populates both caches.
+    Returns a CompiledFlag, or None if the flag does not exist.
     """
-    r = get_redis_client()
+    now = time.monotonic()
+    entry = local_flag_cache.get(flag_name)
+    if entry and entry[0] > now:
+        return entry[1]
+    if is_known_missing(flag_name, now):
+        return None
+
+    shard = pick_shard(flag_name, len(REDIS_SHARDS))
+    r = get_redis_client(shard)
     if r:
         key = f"{REDIS_FLAG_PREFIX}{flag_name}"
-        cached_flag_json = r.get(key)
-        if cached_flag_json:
+        try:
+            cached_flag = r.get(key)
+        except REDIS_UNAVAILABLE_ERRORS as e:
+            mark_redis_unavailable(e, shard)
+            cached_flag = None
+        if cached_flag:
             try:
-                flag_config = json.loads(cached_flag_json)
-                # Ensure targeting_rules are parsed back to dict
-                if 'targeting_rules' in flag_config and isinstance(flag_config['targeting_rules'], str):
-                    flag_config['targeting_rules'] = json.loads(flag_config['targeting_rules'])
-                print(f"Flag '{flag_name}' retrieved from Redis cache.")
-                return flag_config
-            except json.JSONDecodeError as e:
-                print(f"Error decoding cached flag '{flag_name}': {e}. Fetching from DB.")
+                # targeting_rules is stored as a nested map, so one decode yields the full config
+                flag_config = msgpack.unpackb(cached_flag)
+                logger.debug("Flag '%s' retrieved from Redis cache.", flag_name)
+                return remember_flag(flag_config)
+            except ValueError as e: # msgpack's unpack errors (ExtraData, FormatError, ...) are ValueErrors
+                logger.warning("Error decoding cached flag '%s': %s. Fetching from DB.", flag_name, e)
                 # If cache is corrupted, delete it and fetch from DB
                 r.delete(key)
 
     # If not in Redis or Redis is unavailable, fetch from DB
+    writes_before_lookup = flag_write_count
     db = get_db()
     cursor = db.cursor()
-    cursor.execute('SELECT * FROM feature_flags WHERE name = ?', (flag_name,))
+    cursor.execute(f'SELECT {FLAG_COLUMNS} FROM feature_flags WHERE name = ?', (flag_name,))
     flag = cursor.fetchone()
 
     if flag:
-        flag_dict = dict(flag)
-        # Parse targeting rules from JSON string back to a Python object
-        if flag_dict['targeting_rules']:
-            flag_dict['targeting_rules'] = json.loads(flag_dict['targeting_rules'])
-        else:
-            flag_dict['targeting_rules'] = {}
-        
-        # Store in Redis if connected
-        if r:
-            # Store targeting_rules as JSON string in Redis for simpler storage
-            flag_to_cache = dict(flag_dict)
-            flag_to_cache['targeting_rules'] = json.dumps(flag_to_cache['targeting_rules'])
-            r.setex(key, REDIS_CACHE_TTL_SECONDS, json.dumps(flag_to_cache))
-            print(f"Flag '{flag_name}' fetched from DB and stored in Redis.")
-        return flag_dict
+        flag_dict = flag_row_to_dict(flag)
+        logger.debug("Flag '%s' fetched from DB.", flag_name)
+        return cache_flag(flag_dict)
     
-    print(f"Flag '{flag_name}' not found in DB.")
+    logger.debug("Flag '%s' not found in DB.", flag_name)
+    remember_missing_flag(flag_name, writes_before_lookup)
     return None
 
+def get_flags_from_cache_or_db(flag_names):
+    """
+    Batch version of get_flag_from_cache_or_db. Flags missing from the local
+    cache are fetched with one Redis MGET per shard, and any still missing with one
+    SQLite query, so the cost does not grow with a round-trip per flag.
+    Returns a dict of flag name to CompiledFlag; unknown names are left out.
+    """
+    flags = {}
+    now = time.monotonic()
+    pending = []
+    for flag_name in flag_names:
+        entry = local_flag_cache.get(flag_name)
+        if entry and entry[0] > now:
+            flags[flag_name] = entry[1]
+        elif not is_known_missing(flag_name, now):
+            pending.append(flag_name)
+
+    missed = []
+    for shard, shard_names in group_by_shard(pending).items():
+        r = get_redis_client(shard)
+        cached_flags = [None] * len(shard_names)
+        if r:
+            try:
+                cached_flags = r.mget([f"{REDIS_FLAG_PREFIX}{name}" for name in shard_names])
+            except REDIS_UNAVAILABLE_ERRORS as e:
+                mark_redis_unavailable(e, shard)
+        for flag_name, cached_flag in zip(shard_names, cached_flags):
+            if cached_flag:
+                try:
+                    flags[flag_name] = remember_flag(msgpack.unpackb(cached_flag))
+                    continue
+                except ValueError as e: # Corrupted entries are overwritten by the backfill below
+                    logger.warning("Error decoding cached flag '%s': %s. Fetching from DB.", flag_name, e)
+            missed.append(flag_name)
+    pending = missed
+
+    if pending:
+        writes_before_lookup = flag_write_count
+        cursor = get_db().cursor()
+        placeholders = ', '.join('?' * len(pending))
+        cursor.execute(f'SELECT {FLAG_COLUMNS} FROM feature_flags WHERE name IN ({placeholders})', pending)
+        for flag in cache_flags([flag_row_to_dict(row) for row in cursor]):
+            flags[flag.name] = flag
+        for flag_name in pending:
+            if flag_name not in flags:
+                remember_missing_flag(flag_name, writes_before_lookup)
+    return flags
+
 # --- Feature Flag Evaluation Logic ---
-def evaluate_flag(flag_name, user_context=None):
+ROLLOUT_BUCKETS = 10000 # Percentage rollouts are bucketed in basis points (0.01%)
+GOLDEN_RATIO_64 = 0x9E3779B97F4A7C15 # Odd multiplier used to mix user and flag hashes
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+def hash64(value):
+    """Returns a stable 64-bit hash of a string (unlike hash(), which is salted per process)."""
+    return xxhash.xxh3_64_intdigest(value.encode())
+
+def get_rollout_bucket(name_hash, user_hash):
     """
-    Evaluates a feature flag based on its rules and user context.
-    
+    Deterministically maps a (flag, user) pair to a bucket in [0, ROLLOUT_BUCKETS).
+    Mixing the flag's name hash into the user's hash keeps rollouts of different
+    flags independent for the same user, while letting a user be hashed only once
+    when several flags are evaluated together.
+    """
+    return ((((user_hash ^ name_hash) * GOLDEN_RATIO_64) & MASK_64) >> 32) % ROLLOUT_BUCKETS
+
+def evaluate_compiled_flag(flag, user_id=None, user_hash=None):
+    """
+    Evaluates an already loaded CompiledFlag for a user.
+
     Args:
-        flag_name (str): The name of the feature flag.
-        user_context (dict, optional): A dictionary containing user attributes
-                                       (e.g., {'user_id': '123', 'country': 'US'}).
-                                       Defaults to None.
+        flag (CompiledFlag): The flag to evaluate.
+        user_id (str, optional): The user the flag is evaluated for.
+        user_hash (int, optional): hash64 of the user_id, when the caller has
+                                   already computed it for another flag.
 
     Returns:
-        tuple: (evaluated_value, flag_found_status)
-               evaluated_value: The value of the flag for the given context.
-               flag_found_status: True if the flag exists, False otherwise.
+        The value of the flag for the given context, cast to the flag's type.
     """
-    flag_config = get_flag_from_cache_or_db(flag_name)
-    
-    if not flag_config:
-        print(f"Flag '{flag_name}' not found.")
-        return None, False
-
     # 1. Check if the flag is globally enabled/disabled
-    if not flag_config['enabled']:
-        print(f"Flag '{flag_name}' is globally disabled.")
-        return flag_config['default_value'], True
+    if not flag.enabled:
+        logger.debug("Flag '%s' is globally disabled.", flag.name)
+        return flag.value
 
     # 2. Evaluate targeting rules
-    rules = flag_config.get('targeting_rules', {})
-    
     # Simple User ID targeting
-    if 'user_ids' in rules and user_context and 'user_id' in user_context:
-        if user_context['user_id'] in rules['user_ids']:
-            print(f"Flag '{flag_name}' enabled for user_id '{user_context['user_id']}' via user_ids rule.")
-            return flag_config['default_value'], True
+    if flag.user_ids is not None and user_id is not None:
+        if user_id in flag.user_ids:
+            logger.debug("Flag '%s' enabled for user_id '%s' via user_ids rule.", flag.name, user_id)
+            return flag.value
 
     # Simple Percentage Rollout
-    if 'percentage' in rules and isinstance(rules['percentage'], (int, float)):
-        if user_context and 'user_id' in user_context:
+    if flag.percentage_bps is not None:
+        if user_id is not None:
             # Use user_id to ensure consistent bucketing for percentage rollouts
-            # A simple hash or modulo can be used for deterministic assignment
             # Ensure user_id is treated as a string for hashing
-            user_id_str = str(user_context['user_id'])
-            seed = sum(ord(c) for c in user_id_str) # Simple deterministic seed
-            random.seed(seed) # Seed the random generator for consistency per user
-            
-            if random.uniform(0, 100) < rules['percentage']:
-                print(f"Flag '{flag_name}' enabled for user_id '{user_id_str}' via percentage rule ({rules['percentage']}%).")
-                return flag_config['default_value'], True
+            user_id_str = str(user_id)
+            if user_hash is None:
+                user_hash = hash64(user_id_str)
+            if get_rollout_bucket(flag.name_hash, user_hash) < flag.percentage_bps:
+                logger.debug("Flag '%s' enabled for user_id '%s' via percentage rule (%s bps).", flag.name, user_id_str, flag.percentage_bps)
+                return flag.value
             else:
-                print(f"Flag '{flag_name}' disabled for user_id '{user_id_str}' via percentage rule.")
-                return flag_config['default_value'], True
+                logger.debug("Flag '%s' disabled for user_id '%s' via percentage rule.", flag.name, user_id_str)
+                return flag.value
         else:
             # If no user_id for percentage, default to global enabled state
-            print(f"Flag '{flag_name}' defaulting to global enabled state for percentage rule (no user_id).")
-            return flag_config['default_value'], True
+            logger.debug("Flag '%s' defaulting to global enabled state for percentage rule (no user_id).", flag.name)
+            return flag.value
 
-    # If no specific targeting rules apply, or no user context provided,
+    # If no specific targeting rules apply, or no user_id provided,
     # fall back to the global enabled state.
-    print(f"Flag '{flag_name}' enabled globally (no specific rule applied or matched).")
-    return flag_config['default_value'], True
+    logger.debug("Flag '%s' enabled globally (no specific rule applied or matched).", flag.name)
+    return flag.value
 
-# --- API Key Authentication Middleware ---
-@app.before_request
-def authenticate_api_key():
+def evaluate_compiled_flags(flags, user_id=None):
     """
-    Checks for a valid API_KEY for POST, PUT, DELETE requests.
-    This is a basic security measure for write operations.
+    Evaluates several CompiledFlags for the same user.
+    The user_id is hashed at most once, and only if one of the flags actually
+    needs it for a percentage rollout; every flag then reuses that hash.
+
+    Returns:
+        list: The evaluated values, in the same order as flags.
     """
-    if request.method in ['POST', 'PUT', 'DELETE']:
-        if request.headers.get('X-API-Key') != API_KEY:
+    user_hash = None
+    if user_id is not None:
+        if any(flag.enabled and flag.percentage_bps is not None for flag in flags):
+            user_hash = hash64(str(user_id))
+    return [evaluate_compiled_flag(flag, user_id, user_hash) for flag in flags]
+
+# --- API Key Authentication ---
+def require_api_key(view):
+    """
+    Checks for a valid API_KEY before running the decorated endpoint.
+    This is a basic security measure for write operations; read endpoints
+    are left undecorated so they skip the check entirely.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # compare_digest takes the same time wherever the keys differ, so it leaks nothing about API_KEY
+        if not hmac.compare_digest(request.headers.get('X-API-Key', '').encode(), API_KEY_BYTES):
             return jsonify({"error": "Unauthorized: Invalid API Key"}), 401
+        return view(*args, **kwargs)
+    return wrapper
 
 # --- API Endpoints ---
 
 @app.route('/flags', methods=['POST'])
+@require_api_key
 def create_flag():
     """
     Creates a new feature flag.
@@ -220,19 +684,22 @@ def create_flag():
     flag_type = data['type']
     default_value = data.get('default_value')
     enabled = 1 if data.get('enabled', False) else 0
+    error = targeting_rules_error(data.get('targeting_rules'))
+    if error:
+        return jsonify({"error": error}), 400
     
-    # Convert targeting_rules dict to JSON string for storage
-    targeting_rules = json.dumps(data.get('targeting_rules', {}))
+    # Convert targeting_rules dict to JSON string for storage, minus the percentage
+    targeting_rules, percentage_bps = split_targeting_rules(data.get('targeting_rules', {}))
 
     db = get_db()
     cursor = db.cursor()
     try:
         cursor.execute(
-            'INSERT INTO feature_flags (name, type, default_value, enabled, targeting_rules) VALUES (?, ?, ?, ?, ?)',
-            (name, flag_type, default_value, enabled, targeting_rules)
+            f'INSERT INTO feature_flags (name, type, default_value, enabled, targeting_rules, percentage_bps) VALUES (?, ?, ?, ?, ?, ?) RETURNING {FLAG_COLUMNS}',
+            (name, flag_type, default_value, enabled, targeting_rules, percentage_bps)
         )
-        db.commit()
-        invalidate_flag_cache(name) # Invalidate Redis cache for the new flag
+        # Write the row as SQLite stored it (e.g. default_value coerced to TEXT) through to the cache
+        cache_flag(flag_row_to_dict(cursor.fetchone()), notify_peers=True)
         return jsonify({"message": "Flag created successfully", "id": cursor.lastrowid}), 201
     except sqlite3.IntegrityError:
         return jsonify({"error": f"Flag with name '{name}' already exists"}), 409
@@ -242,37 +709,28 @@ def create_flag():
 @app.route('/flags', methods=['GET'])
 def get_all_flags():
     """Retrieves all feature flags."""
-    # For getting all flags, we typically bypass Redis cache to ensure we get a full list
-    # A more advanced system might cache the list of flag names.
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute('SELECT * FROM feature_flags')
-    flags = cursor.fetchall()
-    
-    # Convert row objects to dictionaries and parse JSON rules
-    result = []
-    for flag in flags:
-        flag_dict = dict(flag)
-        if flag_dict['targeting_rules']:
-            flag_dict['targeting_rules'] = json.loads(flag_dict['targeting_rules'])
-        else:
-            flag_dict['targeting_rules'] = {}
-        result.append(flag_dict)
+    # SQLite is the source of truth for which flags exist; the names come from the
+    # UNIQUE index on name, and the configs from the caches with one MGET per shard.
+    cursor = get_db().cursor()
+    cursor.execute('SELECT name FROM feature_flags ORDER BY id')
+    flag_names = [name for (name,) in cursor]
+    flags = get_flags_from_cache_or_db(flag_names)
+    result = [flags[flag_name].config for flag_name in flag_names if flag_name in flags]
     
     return jsonify(result), 200
 
 @app.route('/flags/<string:flag_name>', methods=['GET'])
 def get_flag(flag_name):
     """Retrieves a single feature flag by name."""
-    flag_config = get_flag_from_cache_or_db(flag_name)
+    flag = get_flag_from_cache_or_db(flag_name)
 
-    if flag_config:
-        # Return a copy to avoid modifying cached object directly
-        return jsonify(flag_config), 200
+    if flag:
+        return jsonify(flag.config), 200
     else:
         return jsonify({"error": f"Flag '{flag_name}' not found"}), 404
 
 @app.route('/flags/<string:flag_name>', methods=['PUT'])
+@require_api_key
 def update_flag(flag_name):
     """
     Updates an existing feature flag.
@@ -309,27 +767,30 @@ def update_flag(flag_name):
         set_clauses.append("enabled = ?")
         params.append(1 if data['enabled'] else 0)
     if 'targeting_rules' in data:
+        error = targeting_rules_error(data['targeting_rules'])
+        if error:
+            return jsonify({"error": error}), 400
         set_clauses.append("targeting_rules = ?")
-        params.append(json.dumps(data['targeting_rules']))
+        set_clauses.append("percentage_bps = ?")
+        params.extend(split_targeting_rules(data['targeting_rules']))
 
     if not set_clauses:
         return jsonify({"error": "No valid fields to update"}), 400
 
-    query = f"UPDATE feature_flags SET {', '.join(set_clauses)} WHERE name = ?"
+    # RETURNING gives us the full updated row to write through to the cache
+    query = f"UPDATE feature_flags SET {', '.join(set_clauses)} WHERE name = ? RETURNING {FLAG_COLUMNS}"
     params.append(flag_name)
 
     try:
         cursor.execute(query, tuple(params))
-        db.commit()
-        if cursor.rowcount == 0:
+        updated_flag = cursor.fetchone()
+        if updated_flag is None:
             return jsonify({"error": f"Flag '{flag_name}' not found"}), 404
         
-        # If the name was changed, invalidate both old and new names in cache
+        # If the name was changed, drop the entry cached under the old name
         if 'name' in data and data['name'] != flag_name:
             invalidate_flag_cache(flag_name) # Old name
-            invalidate_flag_cache(data['name']) # New name
-        else:
-            invalidate_flag_cache(flag_name) # Invalidate Redis cache for the updated flag
+        cache_flag(flag_row_to_dict(updated_flag), notify_peers=True)
         
         return jsonify({"message": f"Flag '{flag_name}' updated successfully"}), 200
     except sqlite3.IntegrityError:
@@ -338,6 +799,7 @@ def update_flag(flag_name):
         return jsonify({"error": str(e)}), 500
 
 @app.route('/flags/<string:flag_name>', methods=['DELETE'])
+@require_api_key
 def delete_flag(flag_name):
     """
     Deletes a feature flag.
@@ -347,7 +809,6 @@ def delete_flag(flag_name):
     cursor = db.cursor()
     try:
         cursor.execute('DELETE FROM feature_flags WHERE name = ?', (flag_name,))
-        db.commit()
         if cursor.rowcount == 0:
             return jsonify({"error": f"Flag '{flag_name}' not found"}), 404
         invalidate_flag_cache(flag_name) # Invalidate Redis cache for the deleted flag
@@ -361,39 +822,78 @@ def evaluate(flag_name):
     Evaluates a feature flag for a given user context.
     User context can be passed as query parameters (e.g., ?user_id=123&country=US).
     """
-    user_context = dict(request.args) # Get all query parameters as user context
-    
-    evaluated_value, flag_found = evaluate_flag(flag_name, user_context)
-
-    if flag_found:
-        # Attempt to convert default_value based on stored type
-        # This is a simplification; a full system would handle type casting more robustly
-        flag_config = get_flag_from_cache_or_db(flag_name) # Re-fetch to get type info if needed
-        if flag_config:
-            if flag_config['type'] == 'boolean':
-                # Convert "true"/"false" strings to actual booleans
-                if isinstance(evaluated_value, str):
-                    return jsonify({"flag_name": flag_name, "value": evaluated_value.lower() == 'true'}), 200
-                return jsonify({"flag_name": flag_name, "value": bool(int(evaluated_value)) if evaluated_value is not None else False}), 200
-            elif flag_config['type'] == 'number':
-                try:
-                    return jsonify({"flag_name": flag_name, "value": float(evaluated_value) if evaluated_value is not None else None}), 200
-                except (ValueError, TypeError):
-                    return jsonify({"flag_name": flag_name, "value": None}), 200 # Or handle error
-            elif flag_config['type'] == 'json':
-                try:
-                    return jsonify({"flag_name": flag_name, "value": json.loads(evaluated_value) if evaluated_value is not None else None}), 200
-                except json.JSONDecodeError:
-                    return jsonify({"flag_name": flag_name, "value": None}), 200 # Or handle error
-            else: # string or other types
-                return jsonify({"flag_name": flag_name, "value": evaluated_value}), 200
-        else: # Should not happen if flag_found is True
-            return jsonify({"error": "Internal error: Flag config missing after found"}), 500
-    else:
+    flag = get_flag_from_cache_or_db(flag_name)
+    if not flag:
         return jsonify({"error": f"Flag '{flag_name}' not found"}), 404
 
+    if flag.static_response is not None:
+        # Same answer for every user: reuse the body serialized when the flag was cached
+        return app.response_class(flag.static_response, mimetype='application/json')
+
+    # Only user_id is consulted by targeting rules, so skip copying the rest of the query string
+    user_id = request.args.get('user_id')
+    return jsonify({"flag_name": flag_name, "value": evaluate_compiled_flag(flag, user_id)}), 200
+
+@app.route('/evaluate', methods=['POST'])
+def evaluate_bulk():
+    """
+    Evaluates several feature flags for one user context in a single request.
+    Example JSON body:
+    {
+        "user_context": {"user_id": "123", "country": "US"},
+        "flags": ["new_checkout_flow", "new_dashboard"]
+    }
+    Returns a map of flag name to {"value": ..., "found": true/false}.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'flags' not in data:
+        return jsonify({"error": "Missing required field: flags"}), 400
+    if not isinstance(data['flags'], list) or not all(isinstance(name, str) for name in data['flags']):
+        return jsonify({"error": "flags must be a list of flag names"}), 400
+    user_context = data.get('user_context') or {}
+    if not isinstance(user_context, dict):
+        return jsonify({"error": "user_context must be an object"}), 400
+    user_id = user_context.get('user_id')
+    if user_id is not None:
+        if isinstance(user_id, bool) or not isinstance(user_id, (str, int, float)):
+            return jsonify({"error": "user_context.user_id must be a string or number"}), 400
+        user_id = str(user_id) # Match GET /evaluate, where user_id always arrives as a query string
+
+    flags = get_flags_from_cache_or_db(data['flags'])
+    found_flags = [flags[flag_name] for flag_name in data['flags'] if flag_name in flags]
+
+    result = {flag_name: {"value": None, "found": False} for flag_name in data['flags']}
+    for flag, value in zip(found_flags, evaluate_compiled_flags(found_flags, user_id)):
+        result[flag.name] = {"value": value, "found": True}
+    return jsonify(result), 200
+
+# --- Startup ---
+def close_connections():
+    """Closes the pooled SQLite connections and the Redis clients so a forked child does not share them."""
+    while True:
+        try:
+            db_pool.get_nowait().close()
+        except queue.Empty:
+            break
+    for shard, client in enumerate(redis_shards):
+        if client is not None:
+            client.connection_pool.disconnect()
+            redis_shards[shard] = None
+
+def bootstrap():
+    """
+    Creates the schema and warms the caches once per process that imports the app.
+    Under `gunicorn --preload` that is the master, before workers are forked.
+    """
+    init_db() # Initialize the database when the app starts
+    warm_flag_cache() # Load all flags into Redis once; writes keep it up to date afterwards
+    close_connections() # Each worker opens its own connections after fork
+
 # --- Main Execution ---
 if __name__ == '__main__':
-    init_db() # Initialize the database when the app starts
-    # No global refresh_cache here; flags are loaded on demand into Redis
+    logging.basicConfig(level=logging.INFO) # Set to DEBUG to trace cache hits and flag evaluations
+    bootstrap()
+    start_invalidation_listener() # Evict locally cached flags changed by other workers
     app.run(debug=True, port=5000) # Run the Flask app
+elif os.environ.get('FLAG_SERVICE_BOOTSTRAP', '1') == '1':
+    bootstrap() # Imported by a WSGI server (see gunicorn.conf.py); set FLAG_SERVICE_BOOTSTRAP=0 to skip